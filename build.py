@@ -0,0 +1,378 @@
+import functools
+import gzip
+import json
+import os
+import re
+import shutil
+import struct
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+BASE_DIR = Path(__file__).resolve().parent
+DIST_DIR = Path(os.environ.get("DIST_DIR", str(BASE_DIR / "dist")))
+PRELOAD_MANIFEST = "preload.json"
+PAGES = ["index.html", "product.html", "collections.html", "panier.html", "story.html"]
+ASSETS = ["style.css", "script.js"]
+SRCSET_WIDTHS = [480, 960]
+IMG_SIZES = "(max-width: 900px) 92vw, 600px"
+PRODUIT_IMAGE = re.compile(r'<img\b[^>]*src="(Produit/[^"]+)"[^>]*>')
+RAW_TAGS = ("script", "style", "pre", "textarea", "svg")
+# Styles that only matter after an interaction (hover/focus, the off-canvas
+# menu contents) or are decorative, left to the async stylesheet.
+DEFERRED_PSEUDO = re.compile(r":(hover|focus|focus-visible|focus-within|active)\b")
+DEFERRED_SELECTORS = (".grain", ".menu-panel a", ".menu-close", ".nav-links a::after")
+DEFERRED_MEDIA = ("prefers-reduced-motion", "print")
+
+
+def image_size(path: Path) -> tuple[int, int] | None:
+    try:
+        with path.open("rb") as handle:
+            head = handle.read(26)
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", head[16:24])
+                return width, height
+            if not head.startswith(b"\xff\xd8"):
+                return None
+            handle.seek(2)
+            while True:
+                marker = handle.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                code = marker[1]
+                if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                    continue
+                length_bytes = handle.read(2)
+                if len(length_bytes) < 2:
+                    return None
+                (length,) = struct.unpack(">H", length_bytes)
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", handle.read(5))
+                    return width, height
+                handle.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    css = re.sub(r"([{;]\s*[-\w]+):\s+", r"\1:", css)
+    css = css.replace(";}", "}")
+    return css.strip()
+
+
+def minify_js(js: str) -> str:
+    # Line based by design: keeping the newlines leaves automatic semicolon
+    # insertion intact without needing a real JS parser.
+    lines = []
+    for line in js.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("//"):
+            continue
+        lines.append(stripped)
+    return "\n".join(lines) + "\n"
+
+
+def minify_html(page: str) -> str:
+    pattern = re.compile(
+        r"(<(%s)\b[^>]*>)(.*?)(</\2>)" % "|".join(RAW_TAGS), flags=re.S | re.I
+    )
+    kept: list[str] = []
+
+    def stash(match: re.Match) -> str:
+        tag = match.group(2).lower()
+        body = match.group(3)
+        if tag == "style":
+            body = minify_css(body)
+        elif tag == "script" and body.strip():
+            body = minify_js(body).strip()
+        elif tag == "svg":
+            # Self-closing "/>" is significant in SVG content, only drop the
+            # whitespace between elements.
+            body = re.sub(r">\s+<", "><", body.strip())
+        kept.append(match.group(1) + body + match.group(4))
+        return f"\x00{len(kept) - 1}\x00"
+
+    page = pattern.sub(stash, page)
+    page = re.sub(r"<!--(?!\[if).*?-->", "", page, flags=re.S)
+    page = re.sub(r"\s+", " ", page)
+    page = re.sub(r"([>\x00])\s+(?=[<\x00])", r"\1", page)
+    page = re.sub(r"\s*/>", ">", page)
+    page = re.sub(r"\x00(\d+)\x00", lambda match: kept[int(match.group(1))], page)
+    return page.strip() + "\n"
+
+
+def svg_element_count(page: str) -> int:
+    # Counts elements that are explicitly closed, which is what breaks when
+    # a self-closing tag loses its "/>" and swallows its siblings.
+    blocks = re.findall(r"<svg\b.*?</svg>", page, flags=re.S | re.I)
+    return sum(len(re.findall(r"/>|</[a-zA-Z]", block)) for block in blocks)
+
+
+def split_rules(css: str) -> list[tuple[str, str]]:
+    rules = []
+    depth = 0
+    start = 0
+    prelude = ""
+    for index, char in enumerate(css):
+        if char == "{":
+            if depth == 0:
+                prelude = css[start:index].strip()
+                start = index + 1
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                rules.append((prelude, css[start:index]))
+                start = index + 1
+    return rules
+
+
+def selector_matches(selector: str, used: set[str]) -> bool:
+    if DEFERRED_PSEUDO.search(selector) or selector in DEFERRED_SELECTORS:
+        return False
+    selector = re.sub(r"::?[-\w]+(\([^)]*\))?", "", selector)
+    tokens = set(re.findall(r"[.#][-\w]+", selector))
+    tokens.update(re.findall(r"(?:^|[\s>+~])([a-z][a-z0-9]*)", selector))
+    return tokens <= used
+
+
+def critical_css(css: str, used: set[str]) -> str:
+    output = []
+    for prelude, body in split_rules(css):
+        if prelude.startswith("@media"):
+            if any(feature in prelude for feature in DEFERRED_MEDIA):
+                continue
+            inner = critical_css(body, used)
+            if inner:
+                output.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith("@"):
+            continue
+        else:
+            selectors = [
+                part.strip()
+                for part in prelude.split(",")
+                if selector_matches(part.strip(), used)
+            ]
+            if selectors:
+                output.append(f"{','.join(selectors)}{{{body}}}")
+    return "".join(output)
+
+
+def above_the_fold(page: str) -> str:
+    main_start = page.find("<main")
+    if main_start == -1:
+        return page
+    # Run to the end of the section holding the hero image, which is not
+    # always the first one (index.html opens with a text-only banner).
+    hero = PRODUIT_IMAGE.search(page, main_start)
+    section_end = page.find("</section>", hero.end() if hero else main_start)
+    return page[: section_end if section_end != -1 else None]
+
+
+def hero_container_classes(page: str) -> set[str]:
+    main_start = page.find("<main")
+    if main_start == -1:
+        return set()
+    hero = PRODUIT_IMAGE.search(page, main_start)
+    if not hero:
+        return set()
+    section_start = max(page.rfind("<section", main_start, hero.start()), main_start)
+    fragment = page[section_start : hero.end()]
+    return {token for token in used_selectors(fragment) if token.startswith(".")}
+
+
+def missing_hero_rules(page: str, css: str, critical: str) -> list[str]:
+    expected = critical_css(css, used_selectors(page))
+    missing = []
+    for token in sorted(hero_container_classes(page)):
+        pattern = re.escape(token) + r"(?![-\w])"
+        if re.search(pattern, expected) and not re.search(pattern, critical):
+            missing.append(token)
+    return missing
+
+
+def used_selectors(fragment: str) -> set[str]:
+    used = set(re.findall(r"<([a-z][a-z0-9]*)", fragment))
+    for classes in re.findall(r'class="([^"]*)"', fragment):
+        used.update(f".{name}" for name in classes.split())
+    used.update(f"#{name}" for name in re.findall(r'id="([^"]*)"', fragment))
+    return used
+
+
+def build_variants(src: str, source: Path, width: int) -> list[tuple[str, int]]:
+    variants = []
+    if Image is None:
+        return variants
+    for target in SRCSET_WIDTHS:
+        if target >= width:
+            continue
+        relative = Path(unquote(src))
+        variant = relative.with_name(f"{relative.stem}-{target}w{relative.suffix}")
+        out_path = DIST_DIR / variant
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        with Image.open(source) as image:
+            ratio = target / image.width
+            resized = image.resize(
+                (target, round(image.height * ratio)), Image.Resampling.LANCZOS
+            )
+            if resized.mode not in ("RGB", "L") and source.suffix.lower() in (".jpg", ".jpeg"):
+                resized = resized.convert("RGB")
+            resized.save(out_path, optimize=True)
+        variants.append((quote(variant.as_posix()), target))
+    return variants
+
+
+@functools.lru_cache(maxsize=None)
+def image_srcset(src: str) -> str | None:
+    source = BASE_DIR / unquote(src)
+    size = image_size(source)
+    if not size:
+        return None
+    variants = build_variants(src, source, size[0])
+    if not variants:
+        return None
+    candidates = ", ".join(f"{url} {width}w" for url, width in variants)
+    return f"{candidates}, {src} {size[0]}w"
+
+
+def annotate_images(page: str) -> str:
+    def rewrite(match: re.Match) -> str:
+        tag = match.group(0)
+        src_match = re.search(r'src="(Produit/[^"]+)"', tag)
+        if not src_match:
+            return tag
+        src = src_match.group(1)
+        source = BASE_DIR / unquote(src)
+        size = image_size(source)
+        if not size:
+            return tag
+        width, height = size
+        extra = []
+        if "width=" not in tag:
+            extra.append(f'width="{width}" height="{height}"')
+        srcset = image_srcset(src)
+        if srcset and "srcset=" not in tag:
+            extra.append(f'srcset="{srcset}" sizes="{IMG_SIZES}"')
+        if not extra:
+            return tag
+        return tag[:4] + " " + " ".join(extra) + tag[4:]
+
+    return re.sub(r"<img\b[^>]*>", rewrite, page)
+
+
+def preload_images(page: str) -> tuple[str, list[str]]:
+    sources = []
+    header_end = page.find("</header>")
+    if header_end != -1:
+        logo = PRODUIT_IMAGE.search(page, 0, header_end)
+        if logo and 'loading="lazy"' not in logo.group(0):
+            sources.append(logo.group(1))
+    main_start = page.find("<main")
+    if main_start != -1:
+        hero = PRODUIT_IMAGE.search(page, main_start)
+        if hero:
+            # A preloaded image must not also be lazy, promote it to eager.
+            tag = re.sub(r'\s+loading="lazy"', "", hero.group(0))
+            page = page[: hero.start()] + tag + page[hero.end() :]
+            sources.append(hero.group(1))
+    return page, sources
+
+
+def optimize_page(page: str, css: str) -> tuple[str, list[str]]:
+    critical = minify_css(critical_css(css, used_selectors(above_the_fold(page))))
+    page, images = preload_images(page)
+    # Preloads carry the same srcset as the <img>, otherwise the browser
+    # fetches the full size image and then the variant it actually uses.
+    hints = []
+    headers = []
+    for src in images:
+        srcset = image_srcset(src)
+        if srcset:
+            hints.append(
+                f'<link rel="preload" href="{src}" as="image" '
+                f'imagesrcset="{srcset}" imagesizes="{IMG_SIZES}" />'
+            )
+            headers.append(
+                f'</{src}>; rel=preload; as=image; '
+                f'imagesrcset="{srcset}"; imagesizes="{IMG_SIZES}"'
+            )
+        else:
+            hints.append(f'<link rel="preload" href="{src}" as="image" />')
+            headers.append(f"</{src}>; rel=preload; as=image")
+    stylesheet = '<link rel="stylesheet" href="style.css" />'
+    replacement = "\n".join(
+        [
+            *hints,
+            f"<style>{critical}</style>",
+            '<link rel="preload" href="style.css" as="style" '
+            "onload=\"this.onload=null;this.rel='stylesheet'\" />",
+            f"<noscript>{stylesheet}</noscript>",
+        ]
+    )
+    page = page.replace(stylesheet, replacement, 1)
+    page = annotate_images(page)
+    headers.append("</style.css>; rel=preload; as=style")
+    if 'src="script.js"' in page:
+        headers.append("</script.js>; rel=preload; as=script")
+    return minify_html(page), headers
+
+
+def write_gzip(path: Path) -> int:
+    compressed = gzip.compress(path.read_bytes(), compresslevel=9, mtime=0)
+    path.with_name(path.name + ".gz").write_bytes(compressed)
+    return len(compressed)
+
+
+def build() -> None:
+    if DIST_DIR.exists():
+        shutil.rmtree(DIST_DIR)
+    DIST_DIR.mkdir(parents=True)
+    css = (BASE_DIR / "style.css").read_text(encoding="utf-8")
+    (DIST_DIR / "style.css").write_text(minify_css(css), encoding="utf-8")
+    script = (BASE_DIR / "script.js").read_text(encoding="utf-8")
+    (DIST_DIR / "script.js").write_text(minify_js(script), encoding="utf-8")
+
+    manifest = {}
+    for name in PAGES:
+        source = BASE_DIR / name
+        if not source.exists():
+            continue
+        original = source.read_text(encoding="utf-8")
+        page, headers = optimize_page(original, css)
+        if svg_element_count(page) != svg_element_count(original):
+            raise RuntimeError(f"{name}: SVG elements changed during minification")
+        critical = re.search(r"<style>(.*?)</style>", page, flags=re.S)
+        missing = missing_hero_rules(original, css, critical.group(1) if critical else "")
+        if missing:
+            raise RuntimeError(
+                f"{name}: critical CSS lacks hero image rules for {', '.join(missing)}"
+            )
+        (DIST_DIR / name).write_text(page, encoding="utf-8")
+        manifest[f"/{name}"] = headers
+        print(
+            f"{name}: {source.stat().st_size} -> {len(page.encode('utf-8'))} bytes "
+            f"({write_gzip(DIST_DIR / name)} gzipped)"
+        )
+
+    (DIST_DIR / PRELOAD_MANIFEST).write_text(
+        json.dumps(manifest, indent=2), encoding="utf-8"
+    )
+    for name in ASSETS:
+        before = (BASE_DIR / name).stat().st_size
+        after = (DIST_DIR / name).stat().st_size
+        print(f"{name}: {before} -> {after} bytes ({write_gzip(DIST_DIR / name)} gzipped)")
+    if Image is None:
+        print("Pillow not installed (pip install -r requirements.txt): skipping srcset variants")
+    print(f"Build written to {DIST_DIR}")
+
+
+if __name__ == "__main__":
+    build()
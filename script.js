@@ -167,8 +167,18 @@
   const cartCount = document.querySelector("#cartCount");
   const checkoutForm = document.querySelector("#checkoutForm");
   const checkoutButton = checkoutForm?.querySelector("button[type=\"submit\"]");
+  // Idempotency key of the checkout in progress and the endpoints that already
+  // accepted it, dropped whenever the order changes.
+  let pendingOrderId = "";
+  const deliveredEndpoints = new Set();
+
+  const resetPendingOrder = () => {
+    pendingOrderId = "";
+    deliveredEndpoints.clear();
+  };
 
   const saveCart = () => {
+    resetPendingOrder();
     localStorage.setItem("choufli_cart", JSON.stringify(cartItems));
   };
 
@@ -260,33 +270,61 @@
       url: "https://choufli9ach.onrender.com/api/orders",
       mode: "cors",
       allowOpaque: false,
+      idempotent: true,
     },
     {
       url: "https://script.google.com/macros/s/AKfycbxssDv9ayTHWt2paeP6fBkpxVQnal6MBbbUbbAijqhCSuq6pMOtKEUIndmz-ZjmJ5if/exec",
       mode: "no-cors",
       allowOpaque: true,
+      idempotent: false,
     },
   ];
 
+  const createOrderId = () =>
+    window.crypto?.randomUUID
+      ? window.crypto.randomUUID()
+      : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
+  const postOrder = async (endpoint, payload) => {
+    const headers = { "Content-Type": "application/json" };
+    if (endpoint.idempotent) headers["Idempotency-Key"] = payload.client_order_id;
+    const response = await fetch(endpoint.url, {
+      method: "POST",
+      headers,
+      body: JSON.stringify(payload),
+      mode: endpoint.mode,
+    });
+    if (endpoint.allowOpaque && response.type === "opaque") {
+      return response;
+    }
+    if (!response.ok) {
+      throw new Error(`Order failed: ${endpoint.url}`);
+    }
+    return response;
+  };
+
   const sendOrder = async (payload) => {
-    const results = await Promise.allSettled(
-      orderEndpoints.map(async (endpoint) => {
-        const response = await fetch(endpoint.url, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify(payload),
-          mode: endpoint.mode,
-        });
-        if (endpoint.allowOpaque && response.type === "opaque") {
-          return response;
-        }
-        if (!response.ok) {
-          throw new Error(`Order failed: ${endpoint.url}`);
+    // Sent in order so the API answers first: when it replays an order stored
+    // by an earlier attempt, the sheet copy went out with that attempt too.
+    let replayed = false;
+    let successCount = 0;
+    for (const endpoint of orderEndpoints) {
+      if (deliveredEndpoints.has(endpoint.url) || (replayed && !endpoint.idempotent)) {
+        successCount += 1;
+        continue;
+      }
+      try {
+        const response = await postOrder(endpoint, payload);
+        if (endpoint.idempotent) {
+          const data = await response.json().catch(() => ({}));
+          replayed = Boolean(data.replayed);
         }
-        return response;
-      })
-    );
-    const successCount = results.filter((item) => item.status === "fulfilled").length;
+        deliveredEndpoints.add(endpoint.url);
+        successCount += 1;
+      } catch (error) {
+        // One stored copy is enough to confirm the order, try the next endpoint.
+      }
+    }
     if (successCount === 0) {
       throw new Error("Order failed");
     }
@@ -294,14 +332,18 @@
   };
 
   if (checkoutForm) {
+    checkoutForm.addEventListener("input", resetPendingOrder);
     checkoutForm.addEventListener("submit", async (event) => {
       event.preventDefault();
       if (cartItems.length === 0) {
         alert("Ajoute un produit au panier avant de confirmer.");
         return;
       }
+      // Reused by retries of the same order so the server can deduplicate them.
+      if (!pendingOrderId) pendingOrderId = createOrderId();
       const formData = new FormData(checkoutForm);
       const payload = {
+        client_order_id: pendingOrderId,
         customer: {
           name: String(formData.get("name") || "").trim(),
           phone: String(formData.get("phone") || "").trim(),
@@ -1,12 +1,19 @@
+import asyncio
+import io
 import json
+import hashlib
 import html
 import mimetypes
 import os
+import shutil
 import sqlite3
+import threading
 import urllib.error
 import urllib.parse
 import urllib.request
-from datetime import datetime, timezone
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.message import Message
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
@@ -15,11 +22,21 @@ import base64
 
 
 BASE_DIR = Path(__file__).resolve().parent
+DIST_DIR = Path(os.environ.get("DIST_DIR", str(BASE_DIR / "dist")))
 DATA_DIR = Path(os.environ.get("DATA_DIR", str(BASE_DIR)))
 DB_PATH = Path(os.environ.get("DB_PATH", str(DATA_DIR / "orders.db")))
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin")
 SHEETS_URL = os.environ.get("SHEETS_URL", "").strip()
 SHEETS_KEY = os.environ.get("SHEETS_KEY", "").strip()
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "1024"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+SERVER_ENGINE = os.environ.get("SERVER_ENGINE", "http").strip().lower()
+SERVER_ENGINES = ("http", "asyncio")
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", "15"))
+BODY_TIMEOUT = float(os.environ.get("BODY_TIMEOUT", "60"))
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", str(1024 * 1024)))
 
 
 def is_authorized(handler: BaseHTTPRequestHandler) -> bool:
@@ -363,12 +380,153 @@ def init_db() -> None:
             )
             """
         )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+        if "idempotency_key" not in columns:
+            conn.execute("ALTER TABLE orders ADD COLUMN idempotency_key TEXT")
+        if "request_hash" not in columns:
+            conn.execute("ALTER TABLE orders ADD COLUMN request_hash TEXT")
+        conn.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key
+            ON orders (idempotency_key)
+            """
+        )
+        expire_idempotency_keys(conn)
+
+
+class IdempotencyCache:
+    def __init__(self, max_size: int, ttl: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str | None, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[str | None, dict] | None:
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, request_hash, response = entry
+            if now - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return request_hash, response
+
+    def put(
+        self, key: str, created_at: str, request_hash: str | None, response: dict
+    ) -> None:
+        # Entries expire with the order they replay, not when they were cached.
+        timestamp = datetime.fromisoformat(created_at).timestamp()
+        with self._lock:
+            self._entries[key] = (timestamp, request_hash, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+IDEMPOTENCY_CACHE = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL)
+
+
+def idempotency_cutoff() -> str:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_TTL)
+    return cutoff.isoformat()
+
+
+def expire_idempotency_keys(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        UPDATE orders SET idempotency_key = NULL
+        WHERE idempotency_key IS NOT NULL AND created_at < ?
+        """,
+        (idempotency_cutoff(),),
+    )
+
+
+def order_request_hash(
+    name: str, phone: str, address: str, items_json: str, total: int
+) -> str:
+    canonical = json.dumps([name, phone, address, items_json, total])
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def find_order_by_key(key: str) -> tuple[str | None, dict] | None:
+    cached = IDEMPOTENCY_CACHE.get(key)
+    if cached is not None:
+        return cached
+    with sqlite3.connect(DB_PATH) as conn:
+        row = conn.execute(
+            """
+            SELECT id, request_hash, created_at FROM orders
+            WHERE idempotency_key = ? AND created_at >= ?
+            """,
+            (key, idempotency_cutoff()),
+        ).fetchone()
+    if row is None:
+        return None
+    response = {"status": "ok", "id": row[0]}
+    IDEMPOTENCY_CACHE.put(key, row[2], row[1], response)
+    return row[1], response
+
+
+def load_preload_hints() -> dict[str, str]:
+    manifest = DIST_DIR / "preload.json"
+    try:
+        data = json.loads(manifest.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        path: ", ".join(links)
+        for path, links in data.items()
+        if isinstance(links, list) and links
+    }
+
 
+PRELOAD_HINTS = load_preload_hints()
 
-def read_static_file(path: Path) -> tuple[bytes, str]:
-    content = path.read_bytes()
+
+def resolve_static_path(request_path: str) -> Path | None:
+    path = unquote(request_path.split("?", 1)[0])
+    if path == "/":
+        path = "/index.html"
+    for root in (DIST_DIR, BASE_DIR):
+        file_path = (root / path.lstrip("/")).resolve()
+        if str(file_path).startswith(str(root.resolve())) and file_path.is_file():
+            return file_path
+    return None
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in weights:
+            return weights[coding] > 0
+    return False
+
+
+def static_mime_type(path: Path) -> str:
     mime_type, _ = mimetypes.guess_type(path.name)
-    return content, (mime_type or "application/octet-stream")
+    return mime_type or "application/octet-stream"
 
 
 def fetch_sheet_orders() -> list[dict]:
@@ -432,11 +590,20 @@ class RequestHandler(BaseHTTPRequestHandler):
         status: int,
         content_type: str = "application/json",
         no_cache: bool = False,
+        link: str | None = None,
+        content_encoding: str | None = None,
+        vary: bool = False,
     ) -> None:
         self.send_response(status)
         self.send_header("Content-Type", content_type)
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        if link:
+            self.send_header("Link", link)
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, Idempotency-Key")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         if no_cache:
             self.send_header(
@@ -447,6 +614,20 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_header("Expires", "0")
         self.end_headers()
 
+    def _preload_link(self) -> str | None:
+        path = unquote(self.path.split("?", 1)[0])
+        if path == "/":
+            path = "/index.html"
+        return PRELOAD_HINTS.get(path)
+
+    def _negotiate_encoding(self, file_path: Path) -> tuple[Path, str | None, bool]:
+        variant = file_path.with_name(file_path.name + ".gz")
+        if not file_path.is_relative_to(DIST_DIR.resolve()) or not variant.is_file():
+            return file_path, None, False
+        if accepts_gzip(self.headers.get("Accept-Encoding", "")):
+            return variant, "gzip", True
+        return file_path, None, True
+
     def do_OPTIONS(self) -> None:
         self._set_headers(HTTPStatus.NO_CONTENT)
 
@@ -461,16 +642,19 @@ class RequestHandler(BaseHTTPRequestHandler):
             )
             return
 
-        path = unquote(self.path.split("?", 1)[0])
-        if path == "/":
-            path = "/index.html"
-        file_path = (BASE_DIR / path.lstrip("/")).resolve()
-        if not str(file_path).startswith(str(BASE_DIR)) or not file_path.exists():
+        file_path = resolve_static_path(self.path)
+        if file_path is None:
             self._set_headers(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8")
             return
 
-        _, mime_type = read_static_file(file_path)
-        self._set_headers(HTTPStatus.OK, mime_type)
+        _, content_encoding, vary = self._negotiate_encoding(file_path)
+        self._set_headers(
+            HTTPStatus.OK,
+            static_mime_type(file_path),
+            link=self._preload_link(),
+            content_encoding=content_encoding,
+            vary=vary,
+        )
 
     def do_GET(self) -> None:
         if self.path.startswith("/api/orders"):
@@ -487,24 +671,32 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(render_admin_login())
             return
 
-        path = unquote(self.path.split("?", 1)[0])
-        if path == "/":
-            path = "/index.html"
-        file_path = (BASE_DIR / path.lstrip("/")).resolve()
-        if not str(file_path).startswith(str(BASE_DIR)) or not file_path.exists():
+        file_path = resolve_static_path(self.path)
+        if file_path is None:
             self._set_headers(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8")
             self.wfile.write(b"Not found")
             return
 
+        served_path, content_encoding, vary = self._negotiate_encoding(file_path)
         try:
-            content, mime_type = read_static_file(file_path)
+            handle = served_path.open("rb")
         except OSError:
             self._set_headers(HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain; charset=utf-8")
             self.wfile.write(b"Failed to read file")
             return
 
-        self._set_headers(HTTPStatus.OK, mime_type)
-        self.wfile.write(content)
+        with handle:
+            self._set_headers(
+                HTTPStatus.OK,
+                static_mime_type(file_path),
+                link=self._preload_link(),
+                content_encoding=content_encoding,
+                vary=vary,
+            )
+            self._send_file(handle)
+
+    def _send_file(self, handle: io.BufferedReader) -> None:
+        shutil.copyfileobj(handle, self.wfile)
 
     def do_POST(self) -> None:
         if self.path.startswith("/api/orders"):
@@ -527,6 +719,17 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode("utf-8"))
             return
 
+        idempotency_key = (
+            self.headers.get("Idempotency-Key", "").strip()
+            or str(payload.get("client_order_id") or "").strip()
+        )
+        if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            self._set_headers(HTTPStatus.BAD_REQUEST)
+            self.wfile.write(
+                json.dumps({"error": "Invalid idempotency key"}).encode("utf-8")
+            )
+            return
+
         customer = payload.get("customer") or {}
         name = str(customer.get("name", "")).strip()
         phone = str(customer.get("phone", "")).strip()
@@ -547,23 +750,79 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         created_at = datetime.now(timezone.utc).isoformat()
         items_json = json.dumps(items, ensure_ascii=True)
+        request_hash = order_request_hash(name, phone, address, items_json, total)
+
+        if idempotency_key:
+            try:
+                if self._replay_order(idempotency_key, request_hash):
+                    return
+            except sqlite3.Error:
+                self._set_headers(HTTPStatus.INTERNAL_SERVER_ERROR)
+                self.wfile.write(json.dumps({"error": "Database error"}).encode("utf-8"))
+                return
 
         try:
             with sqlite3.connect(DB_PATH) as conn:
-                conn.execute(
+                if idempotency_key:
+                    expire_idempotency_keys(conn)
+                cursor = conn.execute(
                     """
-                    INSERT INTO orders (name, phone, address, items_json, total, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    INSERT INTO orders (
+                        name, phone, address, items_json, total, created_at,
+                        idempotency_key, request_hash
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                     """,
-                    (name, phone, address, items_json, total, created_at),
+                    (
+                        name,
+                        phone,
+                        address,
+                        items_json,
+                        total,
+                        created_at,
+                        idempotency_key or None,
+                        request_hash if idempotency_key else None,
+                    ),
                 )
+                order_id = cursor.lastrowid
+        except sqlite3.IntegrityError:
+            # Another request with the same key won the insert race.
+            try:
+                if idempotency_key and self._replay_order(idempotency_key, request_hash):
+                    return
+            except sqlite3.Error:
+                pass
+            self._set_headers(HTTPStatus.INTERNAL_SERVER_ERROR)
+            self.wfile.write(json.dumps({"error": "Database error"}).encode("utf-8"))
+            return
         except sqlite3.Error:
             self._set_headers(HTTPStatus.INTERNAL_SERVER_ERROR)
             self.wfile.write(json.dumps({"error": "Database error"}).encode("utf-8"))
             return
 
+        response = {"status": "ok", "id": order_id}
+        if idempotency_key:
+            IDEMPOTENCY_CACHE.put(idempotency_key, created_at, request_hash, response)
         self._set_headers(HTTPStatus.CREATED)
-        self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
+        self.wfile.write(json.dumps(response).encode("utf-8"))
+
+    def _replay_order(self, idempotency_key: str, request_hash: str) -> bool:
+        original = find_order_by_key(idempotency_key)
+        if original is None:
+            return False
+        stored_hash, response = original
+        # Rows stored before request hashes existed cannot be compared.
+        if stored_hash is not None and stored_hash != request_hash:
+            self._set_headers(HTTPStatus.UNPROCESSABLE_ENTITY)
+            self.wfile.write(
+                json.dumps(
+                    {"error": "Idempotency key reused with a different order"}
+                ).encode("utf-8")
+            )
+            return True
+        self._set_headers(HTTPStatus.CREATED)
+        self.wfile.write(json.dumps({**response, "replayed": True}).encode("utf-8"))
+        return True
 
     def handle_list_orders(self) -> None:
         try:
@@ -679,23 +938,239 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         try:
             with sqlite3.connect(DB_PATH) as conn:
+                row = conn.execute(
+                    "SELECT idempotency_key FROM orders WHERE id = ?", (order_id_int,)
+                ).fetchone()
                 conn.execute("DELETE FROM orders WHERE id = ?", (order_id_int,))
         except sqlite3.Error:
             self._set_headers(HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain; charset=utf-8")
             self.wfile.write(b"Database error")
             return
+        if row and row[0]:
+            IDEMPOTENCY_CACHE.discard(row[0])
 
         self.send_response(HTTPStatus.SEE_OTHER)
         self.send_header("Location", "/admin")
         self.end_headers()
 
 
+class BufferedRequestHandler(RequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(
+        self,
+        command: str,
+        path: str,
+        request_version: str,
+        headers: Message,
+        body: bytes,
+        client_address: tuple,
+    ) -> None:
+        # The asyncio engine has already parsed the request, so the socket
+        # handling done by BaseHTTPRequestHandler.__init__ is skipped.
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.requestline = f"{command} {path} {request_version}"
+        self.headers = headers
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+        self.client_address = client_address
+        self.close_connection = False
+        self.status = HTTPStatus.OK
+        self.response_headers: list[tuple[str, str]] = []
+        self.body_file: io.BufferedReader | None = None
+        self.body_size = 0
+
+    def send_response(self, code: int, message: str | None = None) -> None:
+        self.log_request(code)
+        self.status = HTTPStatus(code)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        if keyword.lower() == "connection":
+            self.close_connection = value.lower() == "close"
+            return
+        if keyword.lower() == "content-length":
+            # Always computed by serialize() from what was actually written.
+            return
+        self.response_headers.append((keyword, value))
+
+    def end_headers(self) -> None:
+        pass
+
+    def _send_file(self, handle: io.BufferedReader) -> None:
+        # Keep a duplicate descriptor so the engine can stream the file to the
+        # socket after the handler returns, instead of buffering it here.
+        self.body_file = os.fdopen(os.dup(handle.fileno()), "rb")
+        self.body_size = os.fstat(self.body_file.fileno()).st_size
+
+    def close_body(self) -> None:
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+
+    def serialize(self, keep_alive: bool) -> bytes:
+        body = self.wfile.getvalue()
+        body_length = self.body_size if self.body_file is not None else len(body)
+        lines = [
+            f"HTTP/1.1 {self.status.value} {self.status.phrase}",
+            f"Server: {self.version_string()}",
+            f"Date: {self.date_time_string()}",
+        ]
+        lines.extend(f"{keyword}: {value}" for keyword, value in self.response_headers)
+        if self.command != "HEAD" and self.status not in (
+            HTTPStatus.NO_CONTENT,
+            HTTPStatus.NOT_MODIFIED,
+        ):
+            lines.append(f"Content-Length: {body_length}")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        head = "\r\n".join(lines) + "\r\n\r\n"
+        return head.encode("latin-1") + body
+
+
+def simple_response(status: HTTPStatus) -> bytes:
+    body = status.phrase.encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+def parse_request_head(head: bytes) -> tuple[str, str, str, Message] | None:
+    request_line, _, header_block = head.decode("latin-1").partition("\r\n")
+    parts = request_line.split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        return None
+    headers = Message()
+    for line in header_block.split("\r\n"):
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name.strip():
+            return None
+        headers[name.strip()] = value.strip()
+    return parts[0], parts[1], parts[2], headers
+
+
+async def handle_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    loop = asyncio.get_running_loop()
+    client_address = writer.get_extra_info("peername") or ("", 0)
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT
+                )
+            except asyncio.LimitOverrunError:
+                writer.write(simple_response(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE))
+                break
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                break
+
+            request = parse_request_head(head)
+            if request is None:
+                writer.write(simple_response(HTTPStatus.BAD_REQUEST))
+                break
+            command, path, request_version, headers = request
+
+            if "chunked" in headers.get("Transfer-Encoding", "").lower():
+                writer.write(simple_response(HTTPStatus.NOT_IMPLEMENTED))
+                break
+            try:
+                content_length = int(headers.get("Content-Length", "0"))
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                writer.write(simple_response(HTTPStatus.BAD_REQUEST))
+                break
+            if content_length > MAX_BODY_BYTES:
+                writer.write(simple_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
+                break
+            if (
+                content_length
+                and request_version != "HTTP/1.0"
+                and headers.get("Expect", "").lower() == "100-continue"
+            ):
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                await writer.drain()
+            try:
+                body = await asyncio.wait_for(
+                    reader.readexactly(content_length), BODY_TIMEOUT
+                )
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                break
+
+            connection = headers.get("Connection", "").lower()
+            if request_version == "HTTP/1.0":
+                keep_alive = connection == "keep-alive"
+            else:
+                keep_alive = connection != "close"
+
+            handler = BufferedRequestHandler(
+                command, path, request_version, headers, body, client_address
+            )
+            method = getattr(handler, f"do_{command}", None)
+            if method is None:
+                handler.send_error(HTTPStatus.NOT_IMPLEMENTED)
+            else:
+                try:
+                    # SQLite, Sheets and file reads block, keep them off the loop.
+                    await loop.run_in_executor(None, method)
+                except Exception as exc:
+                    handler.close_body()
+                    handler.log_error("Unhandled error: %s", exc)
+                    writer.write(simple_response(HTTPStatus.INTERNAL_SERVER_ERROR))
+                    break
+
+            keep_alive = keep_alive and not handler.close_connection
+            try:
+                writer.write(handler.serialize(keep_alive))
+                await writer.drain()
+                if handler.body_file is not None and command != "HEAD":
+                    await loop.sendfile(
+                        writer.transport, handler.body_file, count=handler.body_size
+                    )
+            finally:
+                handler.close_body()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def serve_async(host: str, port: int) -> None:
+    server = await asyncio.start_server(
+        handle_connection, host, port, limit=MAX_HEADER_BYTES, backlog=1024
+    )
+    async with server:
+        await server.serve_forever()
+
+
 def main() -> None:
+    if SERVER_ENGINE not in SERVER_ENGINES:
+        raise SystemExit(
+            f"Unknown SERVER_ENGINE {SERVER_ENGINE!r}, expected one of: "
+            + ", ".join(SERVER_ENGINES)
+        )
     init_db()
     port = int(os.environ.get("PORT", "8000"))
-    server = HTTPServer(("0.0.0.0", port), RequestHandler)
-    print(f"API ready on http://localhost:{port}")
+    print(f"API ready on http://localhost:{port} ({SERVER_ENGINE} engine)")
     print("Admin dashboard: http://localhost:%s/admin (user: admin)" % port)
+    if SERVER_ENGINE == "asyncio":
+        asyncio.run(serve_async("0.0.0.0", port))
+        return
+    server = HTTPServer(("0.0.0.0", port), RequestHandler)
     server.serve_forever()
 
 